@@ -1,12 +1,24 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, validator
-from typing import Optional, Dict, Any
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, Field, StringConstraints
+from typing import Optional, Dict, Any, Annotated, List, Literal, NamedTuple
+from contextlib import asynccontextmanager
+import asyncio
+import functools
 import os
 import base64
+import hashlib
+import types
+import queue
 from dotenv import load_dotenv
 import logging
-import aiohttp
+from logging.handlers import QueueHandler, QueueListener
+import httpx
+import orjson
+import redis.asyncio as redis
+from async_lru import alru_cache
+from cachetools import TTLCache
 from tenacity import retry, stop_after_attempt, wait_exponential
 
 # Set up logging
@@ -16,16 +28,73 @@ logger = logging.getLogger(__name__)
 # Load environment variables
 load_dotenv()
 
+# Cache settings: Redis holds results for a day, the small in-process
+# cache absorbs bursts of identical requests without a Redis round-trip
+CACHE_TTL_SECONDS = 86400
+local_cache = TTLCache(maxsize=128, ttl=60)
+
+# Batching settings: coalesce prompts arriving within the window into a
+# single Hugging Face call so the GPU runs them as one batch
+BATCH_MAX_SIZE = 8
+BATCH_WINDOW_SECONDS = 0.050
+
+# Concurrency gate: cap in-flight generations so excess requests fail
+# fast with 503 instead of queuing behind multi-second GPU calls
+MAX_CONCURRENT_GENERATIONS = 16
+SEMAPHORE_WAIT_SECONDS = 0.5
+
+# Hedging: if the primary model has not answered within this delay, fire
+# the fallback model in parallel and take whichever finishes first
+HEDGE_DELAY_SECONDS = 4.0
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create shared HTTP client, Redis connection and batch worker for the app's lifetime"""
+    if not HUGGINGFACE_TOKEN:
+        raise RuntimeError(
+            "HUGGINGFACE_TOKEN not found in environment variables; refusing to start"
+        )
+    # Route log records through a queue so handler I/O happens on a
+    # background thread instead of blocking the event loop
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, logging.StreamHandler())
+    listener.start()
+    logging.getLogger().handlers = [QueueHandler(log_queue)]
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=100),
+        timeout=httpx.Timeout(90.0, connect=5.0)
+    )
+    app.state.redis = redis.Redis.from_url(
+        os.getenv("REDIS_URL", "redis://localhost:6379/0"),
+        decode_responses=False
+    )
+    app.state.batch_queue = asyncio.Queue()
+    app.state.sem = asyncio.Semaphore(MAX_CONCURRENT_GENERATIONS)
+    app.state.in_flight = 0
+    worker = asyncio.create_task(batch_worker(app))
+    yield
+    worker.cancel()
+    await app.state.redis.aclose()
+    await app.state.http.aclose()
+    listener.stop()
+
 app = FastAPI(
     title="AI Art Generator API",
     description="An API for generating AI art using Stable Diffusion",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
-# Check if token exists
+# Token presence is enforced at startup in lifespan()
 HUGGINGFACE_TOKEN = os.getenv('HUGGINGFACE_TOKEN')
-if not HUGGINGFACE_TOKEN:
-    logger.error("HUGGINGFACE_TOKEN not found in environment variables!")
+
+@app.exception_handler(Exception)
+async def unhandled_exception_handler(request: Request, exc: Exception):
+    """Log unexpected errors out-of-band and return a generic 500"""
+    logger.error("Unhandled error in %s %s", request.method, request.url.path, exc_info=exc)
+    return ORJSONResponse({"detail": "Internal server error"}, status_code=500)
 
 # CORS middleware
 app.add_middleware(
@@ -36,30 +105,13 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+Style = Literal["realistic", "abstract", "impressionist", "pixel"]
+
 class ArtRequest(BaseModel):
-    prompt: str
-    style: str
-    width: Optional[int] = 512
-    height: Optional[int] = 512
-
-    @validator('prompt')
-    def validate_prompt_length(cls, v):
-        if len(v) > 500:
-            raise ValueError('Prompt must be less than 500 characters')
-        return v
-
-    @validator('width', 'height')
-    def validate_dimensions(cls, v):
-        if v is not None and (v < 128 or v > 1024):
-            raise ValueError('Dimensions must be between 128 and 1024 pixels')
-        return v
-
-    @validator('style')
-    def validate_style(cls, v):
-        valid_styles = {'realistic', 'abstract', 'impressionist', 'pixel'}
-        if v not in valid_styles:
-            raise ValueError(f'Style must be one of: {", ".join(valid_styles)}')
-        return v
+    prompt: Annotated[str, StringConstraints(max_length=500)]
+    style: Style
+    width: Annotated[int, Field(ge=128, le=1024)] = 512
+    height: Annotated[int, Field(ge=128, le=1024)] = 512
 
 class ArtResponse(BaseModel):
     image: str
@@ -76,7 +128,10 @@ API_URLS = {
 # Try using openjourney model as default
 API_URL = API_URLS["openjourney"]
 
-headers = {"Authorization": f"Bearer {HUGGINGFACE_TOKEN}"}
+headers = types.MappingProxyType({
+    "Authorization": f"Bearer {HUGGINGFACE_TOKEN}",
+    "Content-Type": "application/json"
+})
 
 # Style prompt enhancements
 STYLE_PROMPTS = {
@@ -86,16 +141,143 @@ STYLE_PROMPTS = {
     "pixel": "pixel art style, 16-bit, retro gaming, nostalgic, crisp pixels, masterpiece"
 }
 
+# Precomputed ", <style prompt>" suffixes so the hot path only concatenates
+STYLE_SUFFIXES = {style: f", {prompt}" for style, prompt in STYLE_PROMPTS.items()}
+
+@functools.lru_cache(maxsize=None)
+def payload_template(width: int, height: int) -> tuple:
+    """Fixed byte framing around the variable inputs field for a given output size"""
+    return (b'{"inputs":', b',"parameters":{"width":%d,"height":%d}}' % (width, height))
+
+def build_payload(prompts: List[str], width: int, height: int) -> bytes:
+    """Assemble the request body without serializing the fixed parts per call"""
+    prefix, suffix = payload_template(width, height)
+    inputs = prompts[0] if len(prompts) == 1 else prompts
+    return b"".join((prefix, orjson.dumps(inputs), suffix))
+
+def cache_key(enhanced_prompt: str, width: int, height: int) -> bytes:
+    """Build the cache key for a generation request"""
+    return hashlib.sha256(f"{enhanced_prompt}|{width}x{height}|openjourney".encode()).digest()
+
+async def get_cached_image(r: redis.Redis, key: bytes):
+    """Look up a previously generated image, checking the local cache first"""
+    cached = local_cache.get(key)
+    if cached is not None:
+        return cached
+    try:
+        cached = await r.get(key)
+    except redis.RedisError as e:
+        logger.warning("Redis lookup failed, generating without cache: %s", e)
+        return None
+    if cached is not None:
+        local_cache[key] = cached
+    return cached
+
+async def store_cached_image(r: redis.Redis, key: bytes, content: bytes):
+    """Store a generated image in both cache layers"""
+    local_cache[key] = content
+    try:
+        await r.setex(key, CACHE_TTL_SECONDS, content)
+    except redis.RedisError as e:
+        logger.warning("Redis store failed: %s", e)
+
 @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-async def call_huggingface_api(url: str, headers: dict, payload: dict):
+async def call_huggingface_api(url: str, headers: dict, body: bytes, client: httpx.AsyncClient):
     """
-    Call Hugging Face API with retry logic using aiohttp
+    Call Hugging Face API with retry logic using the shared httpx client
     """
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=headers, json=payload, timeout=90) as response:
-            if response.status != 200:
-                raise Exception(f"API call failed with status {response.status}")
-            return await response.read()
+    response = await client.post(url, headers=headers, content=body)
+    response.raise_for_status()
+    return response.content
+
+class BatchItem(NamedTuple):
+    prompt: str
+    width: int
+    height: int
+    future: asyncio.Future
+
+def split_batch_response(content: bytes, batch_size: int) -> List[bytes]:
+    """Demux an API response into per-request image bytes"""
+    if batch_size == 1:
+        return [content]
+    images = orjson.loads(content)
+    return [base64.b64decode(img) if isinstance(img, str) else base64.b64decode(img["blob"])
+            for img in images]
+
+async def generate_batch(client: httpx.AsyncClient, prompts: List[str], width: int, height: int) -> List[bytes]:
+    """Run one batched generation, hedging with the SD-v1-4 fallback when the primary is slow"""
+    body = build_payload(prompts, width, height)
+
+    primary = asyncio.create_task(call_huggingface_api(API_URL, headers, body, client))
+    done, pending = await asyncio.wait({primary}, timeout=HEDGE_DELAY_SECONDS)
+    hedged = False
+
+    while True:
+        for task in done:
+            if task.exception() is None:
+                for loser in pending:
+                    loser.cancel()
+                logger.info("Successfully received response from Hugging Face API")
+                return split_batch_response(task.result(), len(prompts))
+            logger.error("API call failed: %s", task.exception())
+
+        if not hedged:
+            # Primary is slow or failed; race the fallback model against it
+            logger.info("Hedging with SD-v1-4 fallback model")
+            fallback = asyncio.create_task(
+                call_huggingface_api(API_URLS["sd-v1-4"], headers, body, client)
+            )
+            pending = set(pending) | {fallback}
+            hedged = True
+
+        if not pending:
+            raise HTTPException(
+                status_code=503,
+                detail="Service temporarily unavailable. Please try again later."
+            )
+
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+async def run_bucket(client: httpx.AsyncClient, items: List[BatchItem], width: int, height: int):
+    """Generate one bucket of dimensionally-identical prompts and resolve their futures"""
+    try:
+        images = await generate_batch(client, [item.prompt for item in items], width, height)
+        for item, image in zip(items, images):
+            if not item.future.done():
+                item.future.set_result(image)
+    except Exception as e:
+        for item in items:
+            if not item.future.done():
+                item.future.set_exception(e)
+
+async def batch_worker(app: FastAPI):
+    """Coalesce queued generation requests into batched API calls"""
+    queue = app.state.batch_queue
+    loop = asyncio.get_running_loop()
+    pending_tasks = set()
+    while True:
+        batch = [await queue.get()]
+        deadline = loop.time() + BATCH_WINDOW_SECONDS
+        while len(batch) < BATCH_MAX_SIZE:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+
+        # Only dimensionally-identical requests may share an upstream batch
+        buckets: Dict[tuple, List[BatchItem]] = {}
+        for item in batch:
+            buckets.setdefault((item.width, item.height), []).append(item)
+
+        # Dispatch each bucket as its own task so a slow generation does
+        # not stall collection of the next batch
+        for (width, height), items in buckets.items():
+            task = asyncio.create_task(run_bucket(app.state.http, items, width, height))
+            pending_tasks.add(task)
+            task.add_done_callback(pending_tasks.discard)
 
 @app.get("/")
 async def root():
@@ -108,6 +290,10 @@ async def root():
             "/api/generate": "POST - Generate AI art",
             "/health": "GET - Health check",
             "/styles": "GET - List available styles"
+        },
+        "response_formats": {
+            "application/json": "base64-encoded image with metadata (default)",
+            "image/png": "raw PNG bytes with metadata in X-Art-* headers (send Accept: image/png)"
         }
     }
 
@@ -117,90 +303,114 @@ async def get_styles():
     return {
         style: {
             "description": prompt,
-            "example_prompt": f"A sunset landscape, {prompt}"
+            "example_prompt": f"A sunset landscape, {prompt}",
+            "formats": ["application/json", "image/png"]
         }
         for style, prompt in STYLE_PROMPTS.items()
     }
 
 @app.post("/api/generate")
-async def generate_art(request: ArtRequest):
+async def generate_art(request: ArtRequest, http_request: Request):
     """Generate AI art based on prompt and style"""
-    try:
-        logger.info(f"Received request with prompt: {request.prompt}, style: {request.style}")
-        
-        if not HUGGINGFACE_TOKEN:
-            raise HTTPException(status_code=500, detail="API token not configured")
-
-        # Enhance prompt with style
-        enhanced_prompt = f"{request.prompt}, {STYLE_PROMPTS[request.style]}"
-        logger.info(f"Enhanced prompt: {enhanced_prompt}")
-        
-        # Prepare request payload
-        payload = {
-            "inputs": enhanced_prompt,
-            "parameters": {
-                "width": request.width,
-                "height": request.height
-            }
-        }
+    logger.info("Received request with prompt: %s, style: %s", request.prompt, request.style)
 
+    # Enhance prompt with the precomputed style suffix
+    enhanced_prompt = request.prompt + STYLE_SUFFIXES[request.style]
+    logger.info("Enhanced prompt: %s", enhanced_prompt)
+
+    # Reuse a previously generated image for identical requests
+    key = cache_key(enhanced_prompt, request.width, request.height)
+    content = await get_cached_image(http_request.app.state.redis, key)
+
+    if content is not None:
+        logger.info("Cache hit, skipping Hugging Face API call")
+    else:
+        # Fail fast when too many generations are already in flight
+        sem = http_request.app.state.sem
         try:
-            content = await call_huggingface_api(API_URL, headers, payload)
-            logger.info("Successfully received response from Hugging Face API")
-        except Exception as e:
-            logger.error(f"API call failed after retries: {str(e)}")
-            # Try fallback model if first attempt fails
-            try:
-                logger.info("Attempting fallback to SD-v1-4 model")
-                content = await call_huggingface_api(API_URLS["sd-v1-4"], headers, payload)
-                logger.info("Successfully received response from fallback model")
-            except Exception as e2:
-                logger.error(f"Fallback API call failed: {str(e2)}")
-                raise HTTPException(
-                    status_code=503,
-                    detail="Service temporarily unavailable. Please try again later."
-                )
-
-        # Encode image and prepare metadata
-        try:
-            base64_image = base64.b64encode(content).decode()
-            metadata = {
-                "prompt": request.prompt,
-                "style": request.style,
-                "dimensions": f"{request.width}x{request.height}",
-                "model": "openjourney"
-            }
-            return ArtResponse(image=base64_image, metadata=metadata)
-        except Exception as e:
-            logger.error(f"Error processing response: {str(e)}")
+            await asyncio.wait_for(sem.acquire(), timeout=SEMAPHORE_WAIT_SECONDS)
+        except asyncio.TimeoutError:
             raise HTTPException(
-                status_code=500,
-                detail="Error processing the generated image"
+                status_code=503,
+                detail="Server overloaded. Please try again later."
             )
 
-    except Exception as e:
-        logger.error(f"Error in generate_art: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+        http_request.app.state.in_flight += 1
+        try:
+            # Submit to the batch worker and wait for our slice of the result
+            future = asyncio.get_running_loop().create_future()
+            await http_request.app.state.batch_queue.put(
+                BatchItem(enhanced_prompt, request.width, request.height, future)
+            )
+            content = await future
+        finally:
+            http_request.app.state.in_flight -= 1
+            sem.release()
+
+        await store_cached_image(http_request.app.state.redis, key, content)
+
+    # Clients that accept raw PNG skip the base64 encode (and its 33%
+    # size overhead) entirely; metadata travels in response headers
+    if "image/png" in http_request.headers.get("accept", ""):
+        return Response(
+            content=content,
+            media_type="image/png",
+            headers={
+                "X-Art-Model": "openjourney",
+                "X-Art-Style": request.style,
+                "X-Art-Dimensions": f"{request.width}x{request.height}",
+                "Cache-Control": "no-transform"
+            }
+        )
+
+    # Encode image and prepare metadata; encode through a memoryview
+    # and build the JSON body directly to avoid extra full-image copies
+    base64_image = base64.b64encode(memoryview(content)).decode("ascii")
+    metadata = {
+        "prompt": request.prompt,
+        "style": request.style,
+        "dimensions": f"{request.width}x{request.height}",
+        "model": "openjourney"
+    }
+    return ORJSONResponse(
+        {"image": base64_image, "metadata": metadata},
+        headers={"Cache-Control": "no-transform"}
+    )
+
+@alru_cache(maxsize=1, ttl=10)
+async def probe_huggingface(client: httpx.AsyncClient) -> bool:
+    """Probe the upstream model endpoint, cached for 10s to spare it from load-balancer polling"""
+    try:
+        response = await client.get(API_URL, headers=headers, timeout=5)
+        return response.status_code == 200
+    except (httpx.HTTPError, asyncio.TimeoutError):
+        return False
 
 @app.get("/health")
-async def health_check():
+async def health_check(http_request: Request):
     """Check API health status"""
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(API_URL, headers=headers, timeout=5) as response:
-                api_status = response.status == 200
-    except:
-        api_status = False
+    api_status = await probe_huggingface(http_request.app.state.http)
 
     return {
         "status": "healthy",
         "token_configured": bool(HUGGINGFACE_TOKEN),
         "huggingface_api_status": api_status,
+        "in_flight_generations": http_request.app.state.in_flight,
+        "max_concurrent_generations": MAX_CONCURRENT_GENERATIONS,
         "available_styles": list(STYLE_PROMPTS.keys()),
         "current_model": "openjourney",
         "fallback_model": "stable-diffusion-v1-4"
     }
 
 if __name__ == "__main__":
+    import sys
     import uvicorn
-    uvicorn.run(app, host="127.0.0.1", port=8000)
\ No newline at end of file
+    uvicorn.run(
+        "main:app",
+        host="127.0.0.1",
+        port=8000,
+        # uvloop has no Windows wheels; fall back to the default loop there
+        loop="uvloop" if sys.platform != "win32" else "auto",
+        http="httptools",
+        workers=os.cpu_count()
+    )
\ No newline at end of file
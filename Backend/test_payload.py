@@ -0,0 +1,21 @@
+import json
+
+from main import build_payload
+
+
+def test_single_prompt_round_trips():
+    prompt = 'he said "hi",\n backslash \\ and }brace'
+    body = build_payload([prompt], 512, 768)
+    assert json.loads(body) == {
+        "inputs": prompt,
+        "parameters": {"width": 512, "height": 768}
+    }
+
+
+def test_batched_prompts_round_trip():
+    prompts = ["a cat", "b,c", "ünïcode 🎨"]
+    body = build_payload(prompts, 1024, 1024)
+    assert json.loads(body) == {
+        "inputs": prompts,
+        "parameters": {"width": 1024, "height": 1024}
+    }